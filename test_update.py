@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+import configparser
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import update
+
+from packaging import version
+
+
+TOP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Like the versions git_describe() gives for pythondata-auto itself.
+TOOL_VERSION = version.Version('0.0.post2')
+
+
+def git(*args, cwd=None):
+    return subprocess.check_output(('git',)+args, cwd=cwd).decode('utf-8').strip()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """An empty pythondata-auto checkout with a local upstream repo `up`."""
+    monkeypatch.chdir(tmp_path)
+    for k in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv('GIT_{}_NAME'.format(k), 'LiteX Robot')
+        monkeypatch.setenv('GIT_{}_EMAIL'.format(k), 'robot@example.com')
+    # Allow submodules from local paths.
+    monkeypatch.setenv('GIT_CONFIG_COUNT', '1')
+    monkeypatch.setenv('GIT_CONFIG_KEY_0', 'protocol.file.allow')
+    monkeypatch.setenv('GIT_CONFIG_VALUE_0', 'always')
+    monkeypatch.setitem(update._license_data, 'MIT', 'MIT License\n')
+
+    shutil.copytree(os.path.join(TOP_DIR, 'templates'), 'templates')
+    os.makedirs('srcs')
+    os.makedirs('repos')
+
+    up = tmp_path / 'up'
+    up.mkdir()
+    git('init', '-q', '-b', 'main', cwd=up)
+    for v in ('1.0', '1.1', '1.2'):
+        (up / 'data.txt').write_text(v+'\n')
+        git('add', 'data.txt', cwd=up)
+        git('commit', '-q', '-m', 'Release '+v, cwd=up)
+        git('tag', '-a', '-m', 'Release '+v, 'v'+v, cwd=up)
+    return tmp_path
+
+
+def module_config(src, **kw):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_string("""
+[DEFAULT]
+branch = master
+submodule = False
+
+[x]
+type = software
+human_name = X
+branch = main
+tags_only = True
+contents = data
+license = License :: OSI Approved :: MIT License
+license_spdx = MIT
+""")
+    m = config['x']
+    m['src'] = src
+    for k, v in kw.items():
+        m[k] = v
+    m['tool_version'] = str(TOOL_VERSION)
+    m['tool_version_tuple'] = repr(update.version_tuple(TOOL_VERSION))
+    m['name'] = 'x'
+    m['repo'] = 'pythondata-software-x'
+    m['repo_https'] = 'https://github.com/litex-hub/pythondata-software-x.git'
+    m['py'] = 'pythondata_software_x'
+    m['dir'] = os.path.join(m['py'], m['contents'])
+    return m
+
+
+def test_backfill_submodule(workdir):
+    m = module_config(str(workdir / 'up'), submodule='True')
+    tool_version = TOOL_VERSION
+    tags = update.get_src(m)
+    update.set_version(m, tool_version)
+
+    repo_dir = os.path.join('repos', m['repo'])
+    update.update(m)
+    assert os.path.exists(os.path.join(repo_dir, '.git', 'modules', m['dir']))
+    master = git('rev-parse', 'master', cwd=repo_dir)
+
+    first, last = update.parse_backfill_range('1.0:1.1')
+    btags = update.backfill_tags(tags, first, last)
+    assert [t for t, h in btags] == ['v1.0', 'v1.1']
+    update.backfill(m, btags, tool_version)
+
+    assert git('symbolic-ref', '--short', 'HEAD', cwd=repo_dir) == 'master'
+    assert git('rev-parse', 'master', cwd=repo_dir) == master
+    repo_tags = git('tag', '--list', cwd=repo_dir).split()
+    assert repo_tags == ['v1.0.post2', 'v1.1.post2']
+    for (t, h), repo_tag in zip(btags, repo_tags):
+        assert git('tag', '-l', '--format=%(contents:subject)', repo_tag, cwd=repo_dir) == 'Backfill of '+t
+        gitlink = git('rev-parse', repo_tag+':'+m['dir'], cwd=repo_dir)
+        assert gitlink == git('rev-parse', t+'^{commit}', cwd='up')
+
+
+def test_download_returns_to_master(workdir):
+    m = module_config(str(workdir / 'up'))
+    update.get_src(m)
+    update.set_version(m, TOOL_VERSION)
+
+    repo_dir = os.path.join('repos', m['repo'])
+    update.update(m)
+    git('clone', '-q', '--bare', repo_dir, 'remote.git')
+    m['repo_url'] = str(workdir / 'remote.git')
+    git('remote', 'add', 'origin', m['repo_url'], cwd=repo_dir)
+    git('fetch', '-q', cwd=repo_dir)
+    master = git('rev-parse', 'origin/master', cwd=repo_dir)
+
+    # Left on another branch, like after an interrupted backfill.
+    git('checkout', '-q', '--orphan', 'backfill/v1.0-v1.0', cwd=repo_dir)
+    git('commit', '-q', '-m', 'Backfill', cwd=repo_dir)
+
+    update.download(m)
+    assert git('symbolic-ref', '--short', 'HEAD', cwd=repo_dir) == 'master'
+    assert git('rev-parse', 'HEAD', cwd=repo_dir) == master
+    assert git('rev-parse', 'backfill/v1.0-v1.0', cwd=repo_dir) != master
+
+
+def test_phase_timeout_terminates(tmp_path):
+    marker = tmp_path / 'terminated'
+    cmd = ['sh', '-c', 'trap "touch {}; exit 1" TERM; sleep 30 & wait'.format(marker)]
+    result = {'times': {}}
+    assert not update.run_phase(result, 'download', 0.5, None, update.subprocess_check_call, cmd)
+    assert result['download'][1].startswith('TimeoutExpired')
+    assert marker.exists()
+
+    result = {'times': {}}
+    assert not update.run_phase(result, 'src', 0.5, None, update.subprocess_check_output, ['sleep', '30'])
+    assert result['times']['src'] < 5
+
+
+def test_download_removes_stale_locks(workdir):
+    m = module_config(str(workdir / 'up'))
+    update.get_src(m)
+    update.set_version(m, TOOL_VERSION)
+
+    repo_dir = os.path.join('repos', m['repo'])
+    update.update(m)
+    git('clone', '-q', '--bare', repo_dir, 'remote.git')
+    m['repo_url'] = str(workdir / 'remote.git')
+    git('remote', 'add', 'origin', m['repo_url'], cwd=repo_dir)
+
+    index_lock = os.path.join(repo_dir, '.git', 'index.lock')
+    open(index_lock, 'w').close()
+    update.download(m)
+    assert not os.path.exists(index_lock)
+
+
+def test_buffered_output(capfd):
+    def module(name):
+        print('::group::'+name)
+        update.subprocess_check_call(['echo', name+' command'])
+        out = update.subprocess_check_output(['sh', '-c', 'echo '+name+' out; echo '+name+' err >&2'])
+        assert out == (name+' out\n').encode('utf-8')
+        print('::endgroup::')
+        return name
+
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = update.ThreadOutput(stdout), update.ThreadOutput(stderr)
+    try:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            names = list(executor.map(
+                lambda name: update.buffered_output(module, name), ['a', 'b', 'c', 'd']))
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    assert names == ['a', 'b', 'c', 'd']
+
+    lines = capfd.readouterr().out.splitlines()
+    assert len(lines) == 16
+    for i in range(0, len(lines), 4):
+        name = lines[i][len('::group::'):]
+        assert lines[i:i+4] == [
+            '::group::'+name, name+' command', name+' err', '::endgroup::']
+
+
+def test_index_version_follows_content(workdir, monkeypatch):
+    monkeypatch.setitem(update._license_data, 'Apache-2.0', 'Apache License\n')
+    shutil.copytree(os.path.join(TOP_DIR, 'templates-index'), 'templates-index')
+    config = configparser.ConfigParser(interpolation=None)
+    config['index'] = dict(
+        name='index', repo='pythondata-index', py='pythondata_index',
+        repo_https='https://github.com/litex-hub/pythondata-index.git',
+        description='Index', license='License :: OSI Approved :: Apache Software License',
+        license_spdx='Apache-2.0', tool_version='0.0.post10', tool_version_tuple='(0, 0, 10)')
+    m = config['index']
+    tool_version = version.Version('0.0.post10')
+
+    def entry(data_version):
+        e = {k: k for k in update.INDEX_FIELDS}
+        e['version_tuple'] = '(0, 0, 1)'
+        e['data_version'] = data_version
+        e['data_version_tuple'] = '(0, 0, 1)'
+        return {'pythondata_cpu_x': update.index_entry(e)}
+
+    versions = []
+    for data_version in ('1.0', '1.0', '1.1'):
+        update.update_index(m, ['pythondata_cpu_x'], entry(data_version), tool_version)
+        versions.append(m['version'])
+    assert versions == ['0.0.post11', '0.0.post11', '0.0.post12']
+
+
+def test_backfill_rerun(workdir):
+    m = module_config(str(workdir / 'up'))
+    tool_version = TOOL_VERSION
+    tags = update.get_src(m)
+    assert 'v0.0' in tags
+    update.set_version(m, tool_version)
+
+    repo_dir = os.path.join('repos', m['repo'])
+    update.update(m)
+
+    update.backfill(m, update.backfill_tags(tags, *update.parse_backfill_range(':1.1')), tool_version)
+    repo_tags = git('tag', '--list', cwd=repo_dir).split()
+    assert repo_tags == ['v1.0.post2', 'v1.1.post2']
+    backfilled = {t: git('rev-parse', t, cwd=repo_dir) for t in repo_tags}
+    branches = git('branch', '--list', cwd=repo_dir)
+
+    # Re-running the same range changes nothing.
+    update.backfill(m, update.backfill_tags(tags, *update.parse_backfill_range(':1.1')), tool_version)
+    assert {t: git('rev-parse', t, cwd=repo_dir) for t in repo_tags} == backfilled
+    assert git('branch', '--list', cwd=repo_dir) == branches
+
+    # A wider range only adds the new tag.
+    update.backfill(m, update.backfill_tags(tags, *update.parse_backfill_range(':')), tool_version)
+    repo_tags = git('tag', '--list', cwd=repo_dir).split()
+    assert repo_tags == ['v1.0.post2', 'v1.1.post2', 'v1.2.post2']
+    data_version = git('show', 'v1.2.post2:pythondata_software_x/__init__.py', cwd=repo_dir)
+    assert 'data_version_str = "1.2.post0"' in data_version
+    assert 'version_str = "1.2.post2"' in data_version
+    assert {t: git('rev-parse', t, cwd=repo_dir) for t in backfilled} == backfilled
+    assert git('symbolic-ref', '--short', 'HEAD', cwd=repo_dir) == 'master'
+
+
+def test_maintain_budget(workdir, monkeypatch):
+    m = module_config(str(workdir / 'up'))
+    update.get_src(m)
+    update.set_version(m, TOOL_VERSION)
+    update.update(m)
+
+    monkeypatch.setattr(update, 'MAINTENANCE_TASKS', (
+        ['git', 'pack-refs', '--all'],
+        ['sleep', '30'],
+        ['git', 'commit-graph', 'write', '--reachable'],
+    ))
+    start = time.monotonic()
+    update.maintain(m, 1)
+    assert time.monotonic() - start < 10
+    # The task after the one stopped by the budget was skipped.
+    assert not os.path.exists(os.path.join('srcs', m['repo'], 'objects', 'info', 'commit-graph'))
+
+
+def test_backfill_rerun_new_tool_version(workdir):
+    m = module_config(str(workdir / 'up'))
+    tags = update.get_src(m)
+    update.set_version(m, TOOL_VERSION)
+    repo_dir = os.path.join('repos', m['repo'])
+    update.update(m)
+
+    btags = update.backfill_tags(tags, *update.parse_backfill_range('1.0:1.1'))
+    update.backfill(m, btags, TOOL_VERSION)
+    repo_tags = git('tag', '--list', cwd=repo_dir).split()
+    assert repo_tags == ['v1.0.post2', 'v1.1.post2']
+    branches = git('branch', '--list', cwd=repo_dir)
+
+    # A newer pythondata-auto doesn't backfill the same releases again.
+    update.backfill(m, btags, version.Version('0.0.post3'))
+    assert git('tag', '--list', cwd=repo_dir).split() == repo_tags
+    assert git('branch', '--list', cwd=repo_dir) == branches
+
+    # An existing backfill branch is never replaced.
+    git('tag', '-d', *repo_tags, cwd=repo_dir)
+    with pytest.raises(ValueError, match='already exists'):
+        update.backfill(m, btags, version.Version('0.0.post3'))
+    assert git('symbolic-ref', '--short', 'HEAD', cwd=repo_dir) == 'master'
+
+
+def test_push_backfill_tags(workdir, monkeypatch):
+    monkeypatch.delenv('GH_TOKEN', raising=False)
+    m = module_config(str(workdir / 'up'))
+    tags = update.get_src(m)
+    update.set_version(m, TOOL_VERSION)
+    repo_dir = os.path.join('repos', m['repo'])
+    update.update(m)
+    git('init', '-q', '--bare', 'remote.git')
+    git('remote', 'add', 'origin', str(workdir / 'remote.git'), cwd=repo_dir)
+    git('push', '-q', 'origin', 'master', cwd=repo_dir)
+
+    update.backfill(m, update.backfill_tags(tags, *update.parse_backfill_range('1.0:1.1')), TOOL_VERSION)
+    # A master which can't be pushed doesn't stop the tags being pushed.
+    git('commit', '-q', '--amend', '-m', 'Diverged', cwd=repo_dir)
+    m['backfill'] = '1.0:1.1'
+    with pytest.raises(subprocess.CalledProcessError):
+        update.push(m)
+    assert git('tag', '--list', cwd='remote.git').split() == ['v1.0.post2', 'v1.1.post2']
+
+
+def test_sparse_new_repo(workdir):
+    m = module_config(str(workdir / 'up'), sparse='True')
+    update.get_src(m)
+    update.set_version(m, TOOL_VERSION)
+
+    # No download, so update() creates the repo with `git init`.
+    repo_dir = os.path.join('repos', m['repo'])
+    update.update(m)
+    assert update.has_sparse_checkout(repo_dir)
+    assert not os.path.exists(os.path.join(repo_dir, m['dir']))
+    assert os.path.exists(os.path.join(repo_dir, 'setup.py'))
+    assert git('show', 'HEAD:'+m['dir']+'/data.txt', cwd=repo_dir) == '1.2'
+
+
+def test_sparse_clone_update(workdir):
+    m = module_config(str(workdir / 'up'), sparse='True')
+    update.get_src(m)
+    update.set_version(m, TOOL_VERSION)
+
+    repo_dir = os.path.join('repos', m['repo'])
+    update.update(m)
+    git('clone', '-q', '--bare', repo_dir, 'remote.git')
+    m['repo_url'] = str(workdir / 'remote.git')
+    shutil.rmtree(repo_dir)
+
+    update.download(m)
+    assert update.has_sparse_checkout(repo_dir)
+    assert not os.path.exists(os.path.join(repo_dir, m['dir']))
+    assert os.path.exists(os.path.join(repo_dir, 'setup.py'))
+
+    (workdir / 'up' / 'data.txt').write_text('1.3\n')
+    git('commit', '-q', '-a', '-m', 'Release 1.3', cwd='up')
+    git('tag', '-a', '-m', 'Release 1.3', 'v1.3', cwd='up')
+    update.get_src(m)
+    update.set_version(m, TOOL_VERSION)
+    update.update(m)
+
+    assert not os.path.exists(os.path.join(repo_dir, m['dir']))
+    parents = git('rev-list', '--parents', '-n', '1', 'HEAD', cwd=repo_dir).split()
+    assert parents[2] == git('rev-parse', 'v1.3^{commit}', cwd='up')
+    assert git('show', 'HEAD:'+m['dir']+'/data.txt', cwd=repo_dir) == '1.3'